@@ -6,22 +6,49 @@ This script optimally combines multi-echo BOLD images using tedana and applies
 spatial transformations to generate outputs in native and MNI space.
 """
 
+import bisect
+import errno
+import functools
 import gc
+import gzip
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
+import re
 import psutil
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Set
 
 import argparse
 import nibabel as nib
-from nilearn import image
-from nibabel.nifti1 import Nifti1Image
-from nipype.interfaces.ants import ApplyTransforms
-from nipype import config
+import numpy as np
+from nibabel.openers import ImageOpener
+from threadpoolctl import threadpool_limits
 from tedana.workflows import t2smap_workflow, tedana_workflow
 
+try:
+    import orjson
+except ImportError:  # optional; only speeds up sidecar parsing
+    orjson = None
+
+
+# Output spaces the optimally combined image can be resampled into
+OUTPUT_SPACES = ("T1w", "MNI152NLin2009cAsym")
+
+_T1W_TO_MNI_RE = re.compile(r".*_from-T1w_to-MNI152NLin2009cAsym_mode-image_xfm\.h5")
+_ECHO_FILE_RE = re.compile(r".*echo-.*desc-preproc_bold\.nii\.gz")
+_BIDS_RE = re.compile(r"(?:^|_)(sub|ses|task|run)-([A-Za-z0-9]+)")
+
 
 @dataclass
 class EchoFileInfo:
@@ -61,31 +88,42 @@ class TedanaProcessor:
         output_dir: Path,
         subject_id: str,
         trim_by: int = None,
-        apptainer_image: str = None,
         task_name: str = None,
         full_pipeline: bool = False,
         skip_ants_transform: bool = False,
         use_fmriprep_mask: bool = False,
+        jobs: int = 1,
+        spaces: Optional[List[str]] = None,
+        ants_threads: Optional[int] = None,
+        interpolation: str = "BSpline",
+        float_precision: bool = True,
     ):
         self.fmriprep_dir = fmriprep_dir
         self.output_dir = output_dir
         self.subject_id = self._normalize_subject_id(subject_id)
         self.trim_by = trim_by or 0
-        self.apptainer_image = apptainer_image
         self.task_name = task_name
         self.full_pipeline = full_pipeline
         self.skip_ants_transform = skip_ants_transform
         self.use_fmriprep_mask = use_fmriprep_mask
+        # jobs <= 0 means one worker per available CPU
+        self.jobs = jobs if jobs > 0 else _available_cpus()
+        self.spaces = list(spaces or OUTPUT_SPACES)
+        # Up to two ANTs calls run at once per run, so split cores across them
+        self.ants_threads = ants_threads or max(
+            1, min(8, _available_cpus() // (self.jobs * 2))
+        )
+        # BSpline in single precision is what fMRIPrep uses for BOLD; Lanczos
+        # and double precision remain available for callers that need them
+        self.interpolation = interpolation
+        self.float_precision = float_precision
         self.logger = self._setup_logging()
-
-        # Configure nipype to use apptainer if image is provided.
-        # NOTE: I added this because there were issues with the 
-        # batch submission not accessing ANTS binaries from the container.
-        # I'm not sure if this is the best way to handle it though. I might 
-        # try something different in the container itself to better expose those paths.
-        if self.apptainer_image:
-            config.set("execution", "use_relative_paths", True)
-            config.set("execution", "stop_on_first_crash", True)
+        self._t1w_to_mni: Dict[Optional[str], Path] = {}
+        # Filled by the discovery walk in _find_echo_files, which process() runs
+        # before any sidecar, mask or transform lookup
+        self._t1w_to_mni_files: List[Path] = []
+        self._file_index: Set[Path] = set()
+        self._te_cache: Dict[Path, float] = {}
 
     @staticmethod
     def _normalize_subject_id(subject_id: str) -> str:
@@ -100,6 +138,12 @@ class TedanaProcessor:
         )
         return logging.getLogger(__name__)
 
+    def _ants_env(self) -> Dict[str, str]:
+        """Environment for ANTs subprocesses with the ITK thread count set."""
+        env = os.environ.copy()
+        env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(self.ants_threads)
+        return env
+
     def _log_memory_usage(self, stage: str) -> None:
         """Log current memory usage."""
         process = psutil.Process()
@@ -109,15 +153,8 @@ class TedanaProcessor:
 
     def _parse_filename_components(self, filename: str) -> Dict[str, str]:
         """Extract BIDS components from filename."""
-        components = filename.split("_")
-        return {
-            "sub": next((comp for comp in components if comp.startswith("sub-")), None),
-            "ses": next((comp for comp in components if comp.startswith("ses-")), None),
-            "task": next(
-                (comp for comp in components if comp.startswith("task-")), None
-            ),
-            "run": next((comp for comp in components if comp.startswith("run-")), None),
-        }
+        # Copy so callers can't mutate the cached entry
+        return dict(_parse_bids_entities(filename))
 
     def _create_run_key(self, components: Dict[str, str]) -> str:
         """Create a unique key for grouping runs."""
@@ -126,56 +163,164 @@ class TedanaProcessor:
         ]
         return "_".join(key_parts)
 
+    @staticmethod
+    def _scan_files(directory: Path):
+        """Yield a DirEntry for every file below directory using os.scandir."""
+        pending = [directory]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    # Don't follow directory symlinks, like Path.glob("**"), so
+                    # a symlink cycle can't make the walk loop forever
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+
     def _find_echo_files(self) -> List[Path]:
-        """Find all echo files for the subject."""
+        """Find all echo files for the subject in a single walk of its directory."""
         subject_dir = self.fmriprep_dir / self.subject_id
         if not subject_dir.exists():
             raise ValueError(f"Subject directory does not exist: {subject_dir}")
 
         if self.task_name:
-            pattern = f"*task-{self.task_name}*echo-*desc-preproc_bold.nii.gz"
+            echo_re = re.compile(
+                rf".*task-{re.escape(self.task_name)}.*echo-.*desc-preproc_bold\.nii\.gz"
+            )
         else:
-            pattern = "*echo-*desc-preproc_bold.nii.gz"
-        echo_files = list(subject_dir.glob(f"**/{pattern}"))
+            echo_re = _ECHO_FILE_RE
+
+        # Pick up the anat transform during the same walk so it needs no glob
+        # later, and index every file so sidecar/transform lookups need no stat
+        echo_files = []
+        t1w_to_mni_files = []
+        file_index = set()
+        for entry in self._scan_files(subject_dir):
+            file_index.add(Path(entry.path))
+            if echo_re.fullmatch(entry.name):
+                echo_files.append(Path(entry.path))
+            elif _T1W_TO_MNI_RE.fullmatch(entry.name):
+                if Path(entry.path).parent.name == "anat":
+                    t1w_to_mni_files.append(Path(entry.path))
+
+        self._t1w_to_mni_files = t1w_to_mni_files
+        self._file_index = file_index
+
+        echo_files.sort()
         self.logger.info(f"Found {len(echo_files)} echo files for {self.subject_id}")
         return echo_files
 
-    def _get_echo_file_info(self, echo_file: Path) -> EchoFileInfo:
-        """Extract echo time from JSON sidecar without loading image."""
+    def _file_exists(self, path: Path) -> bool:
+        """Check for a subject file against the index from the directory walk."""
+        return path in self._file_index
+
+    def _read_echo_time(self, echo_file: Path) -> float:
+        """Read EchoTime from an echo's JSON sidecar."""
         json_file = echo_file.with_suffix("").with_suffix(".json")
-        if not json_file.exists():
+        if not self._file_exists(json_file):
             raise FileNotFoundError(f"JSON sidecar not found: {json_file}")
 
-        with open(json_file) as f:
-            metadata = json.load(f)
+        if orjson is not None:
+            metadata = orjson.loads(json_file.read_bytes())
+        else:
+            with open(json_file) as f:
+                metadata = json.load(f)
 
         echo_time = metadata.get("EchoTime")
         if echo_time is None:
             raise ValueError(f"EchoTime not found in {json_file}")
+        return echo_time
+
+    def _get_echo_file_info(self, echo_file: Path) -> EchoFileInfo:
+        """Extract echo time from JSON sidecar without loading image."""
+        if echo_file not in self._te_cache:
+            self._te_cache[echo_file] = self._read_echo_time(echo_file)
 
         return EchoFileInfo(
-            file_path=echo_file, echo_time=echo_time, json_path=json_file
+            file_path=echo_file,
+            echo_time=self._te_cache[echo_file],
+            json_path=echo_file.with_suffix("").with_suffix(".json"),
         )
 
-    def _load_echo_image(self, echo_info: EchoFileInfo) -> Nifti1Image:
-        """Load and optionally trim a single echo image.s"""
-        # Use memory mapping for large files
-        img = nib.load(echo_info.file_path, mmap=True)
+    def _write_trimmed_echo(self, echo_info: EchoFileInfo, output_path: Path) -> Path:
+        """Stream a trimmed copy of an echo to an uncompressed NIfTI, one volume at a time."""
+        img = _load_nifti(echo_info.file_path)
+        header = img.header
+        # The loaded header has its offset and scaling reset; the proxy keeps them
+        data_offset = img.dataobj.offset
+        shape = header.get_data_shape()
+        dtype = header.get_data_dtype()
+        n_volumes = shape[3]
+        if self.trim_by >= n_volumes:
+            raise ValueError(
+                f"Cannot trim {self.trim_by} volumes from {echo_info.file_path} "
+                f"with only {n_volumes} volumes"
+            )
 
-        if self.trim_by > 0:
-            # Convert to nilearn image for trimming, then back to nibabel
-            nilearn_img = image.load_img(echo_info.file_path)
-            nilearn_img = image.index_img(nilearn_img, slice(self.trim_by, None))
-            # Convert back to nibabel format
-            img = nib.Nifti1Image(
-                nilearn_img.get_fdata(), nilearn_img.affine, nilearn_img.header
+        # Only the number of volumes changes; dtype and scaling are kept as on disk
+        out_header = header.copy()
+        out_header.set_data_shape(shape[:3] + (n_volumes - self.trim_by,))
+        out_header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+        # NIfTI stores time as the slowest axis, so the kept volumes are one
+        # contiguous byte range; copy it raw, one volume-sized chunk at a time.
+        # Gzip seeks only decompress forward, so nothing is read twice.
+        vol_bytes = int(np.prod(shape[:3])) * dtype.itemsize
+        with ImageOpener(echo_info.file_path, "rb") as src, open(output_path, "wb") as out:
+            out_header.write_to(out)
+            out.write(b"\x00" * (out_header.get_data_offset() - out.tell()))
+
+            src.seek(data_offset + self.trim_by * vol_bytes)
+            for _ in range(n_volumes - self.trim_by):
+                chunk = src.read(vol_bytes)
+                if len(chunk) != vol_bytes:
+                    raise ValueError(f"Unexpected end of data in {echo_info.file_path}")
+                out.write(chunk)
+
+        return output_path
+
+    def _make_trim_dir(self, run_group: RunGroup, output_dir: Path) -> Path:
+        """Create a scratch directory for trimmed echoes, preferring RAM-backed tmpfs."""
+        # tedana only accepts file paths, so the trimmed echoes still have to be
+        # written somewhere; /dev/shm avoids a round trip through the shared FS
+        needed = 0
+        for echo_info in run_group.echo_files:
+            header = _load_nifti(echo_info.file_path).header
+            shape = header.get_data_shape()
+            needed += (
+                int(np.prod(shape[:3]))
+                * max(shape[3] - self.trim_by, 0)
+                * header.get_data_dtype().itemsize
             )
-            # Clean up intermediate image
-            # - Doing this to reduce memory consumption. Before I was struggling with 
-            # how much memory executing this script required.
-            del nilearn_img 
 
-        return img
+        shm = Path("/dev/shm")
+        if shm.is_dir() and os.access(shm, os.W_OK):
+            if shutil.disk_usage(shm).free > needed:
+                return Path(tempfile.mkdtemp(prefix=f"{run_group.key}_", dir=shm))
+            self.logger.info(
+                f"Not enough space in {shm} for trimmed echoes of {run_group.key}, "
+                f"writing them to {output_dir}"
+            )
+        return Path(tempfile.mkdtemp(prefix="temp_trimmed_", dir=output_dir))
+
+    def _write_trimmed_echoes(self, run_group: RunGroup, trim_dir: Path) -> List[str]:
+        """Write trimmed copies of every echo in a run into trim_dir."""
+        temp_files = [
+            trim_dir / f"temp_echo-{i + 1:02d}_trimmed.nii"
+            for i in range(len(run_group.echo_files))
+        ]
+        self.logger.info(
+            f"Trimming {len(run_group.echo_files)} echoes for {run_group.key}"
+        )
+        # Stream the kept volumes to uncompressed temp files. Each echo
+        # is a separate file and zlib releases the GIL while
+        # decompressing, so threads trim the echoes in parallel.
+        with ThreadPoolExecutor(max_workers=len(temp_files)) as executor:
+            list(
+                executor.map(
+                    self._write_trimmed_echo, run_group.echo_files, temp_files
+                )
+            )
+        return [str(temp_file) for temp_file in temp_files]
 
     def _find_transform_files(self, echo_file: Path) -> TransformFiles:
         """Find transformation files for a given echo file."""
@@ -193,82 +338,246 @@ class TedanaProcessor:
         transform_files = {}
         for key, pattern in patterns.items():
             file_path = file_dir / pattern
-            if not file_path.exists():
+            if not self._file_exists(file_path):
                 raise FileNotFoundError(f"Transform file not found: {file_path}")
             transform_files[key] = file_path
 
-        # Find T1w to MNI transform (in anat directory)
-        anat_pattern = "*_from-T1w_to-MNI152NLin2009cAsym_mode-image_xfm.h5"
-        t1w_to_mni_files = list(file_dir.parent.parent.glob(f"**/anat/{anat_pattern}"))
-        if not t1w_to_mni_files:
-            raise FileNotFoundError(
-                f"T1w to MNI transform not found with pattern: {anat_pattern}"
-            )
-
-        # TODO: Check there is only one of this
-        # - I think this should correctly find the /anat/ fmriprep 
-        # directory, but we had troubles with this before. I'll have to 
-        # think more about whether this is a robust enough solution.
-        transform_files["t1w_to_mni"] = t1w_to_mni_files[0]
+        transform_files["t1w_to_mni"] = self._find_t1w_to_mni(echo_file)
 
         return TransformFiles(**transform_files)
 
-    def _group_echoes_by_run(self, echo_files: List[Path]) -> Dict[str, RunGroup]:
-        """Group echo files by run without loading image data."""
-        run_groups = {}
+    def _find_t1w_to_mni(self, echo_file: Path) -> Path:
+        """Find the T1w to MNI transform for an echo's session, once per session."""
+        session = self._parse_filename_components(echo_file.name)["ses"]
+        if session in self._t1w_to_mni:
+            return self._t1w_to_mni[session]
+
+        # Search the echo's own session first (func/.. is the session directory,
+        # or the subject directory without sessions), then the subject-level
+        # anat directory used when the anatomical is shared across sessions
+        subject_dir = self.fmriprep_dir / self.subject_id
+        session_dir = echo_file.parent.parent
+        search = [(session_dir, True)]
+        if session_dir != subject_dir:
+            search.append((subject_dir, False))
+
+        for search_dir, recursive in search:
+            # The discovery walk saw every anat transform, so filter its matches
+            t1w_to_mni_files = [
+                path
+                for path in self._t1w_to_mni_files
+                if (search_dir in path.parents if recursive
+                    else path.parent == search_dir / "anat")
+            ]
+            if t1w_to_mni_files:
+                break
+        else:
+            raise FileNotFoundError(
+                f"T1w to MNI transform not found for {echo_file.name} under "
+                f"{session_dir} or {subject_dir / 'anat'}"
+            )
 
+        self._t1w_to_mni[session] = self._select_t1w_to_mni(t1w_to_mni_files)
+        return self._t1w_to_mni[session]
+
+    def _select_t1w_to_mni(self, t1w_to_mni_files: List[Path]) -> Path:
+        """Pick one T1w to MNI transform from the candidates found."""
+        # Candidates are already scoped to one session's anat tree, so more than
+        # one means an unusual layout; pick deterministically and say so
+        t1w_to_mni_files = sorted(t1w_to_mni_files)
+        if len(t1w_to_mni_files) > 1:
+            self.logger.warning(
+                f"Found {len(t1w_to_mni_files)} T1w to MNI transforms, "
+                f"using {t1w_to_mni_files[0]}"
+            )
+        return t1w_to_mni_files[0]
+
+    def _group_paths_by_run(self, echo_files: List[Path]) -> Dict[str, List[Path]]:
+        """Group echo files by run from their filenames alone."""
+        path_groups = {}
         for echo_file in echo_files:
-            # Parse filename components
             components = self._parse_filename_components(echo_file.name)
             run_key = self._create_run_key(components)
+            path_groups.setdefault(run_key, []).append(echo_file)
+        return path_groups
+
+    def _load_grouped_echoes(
+        self, path_groups: Dict[str, List[Path]]
+    ) -> Dict[str, RunGroup]:
+        """Read echo metadata, transforms and masks for already-grouped runs."""
+        run_groups = {}
 
-            # Get echo file info without loading image
-            echo_info = self._get_echo_file_info(echo_file)
+        # Every echo's own sidecar is authoritative, so each one is read; do it
+        # concurrently since each is a small, latency-bound read
+        pending = [
+            echo_file
+            for echo_paths in path_groups.values()
+            for echo_file in echo_paths
+            if echo_file not in self._te_cache
+        ]
+        with ThreadPoolExecutor(max_workers=min(8, max(len(pending), 1))) as executor:
+            echo_times = executor.map(self._read_echo_time, pending)
+            self._te_cache.update(zip(pending, echo_times))
+
+        for run_key, echo_paths in path_groups.items():
+            for echo_file in echo_paths:
+                # Get echo file info without loading image
+                echo_info = self._get_echo_file_info(echo_file)
+
+                # Create or update run group
+                if run_key not in run_groups:
+                    # Only find transform files once per run
+                    transforms = self._find_transform_files(echo_file)
+                    run_groups[run_key] = RunGroup(
+                        key=run_key, echo_files=[], transforms=transforms
+                    )
 
-            # Create or update run group
-            if run_key not in run_groups:
-                # Only find transform files once per run
-                transforms = self._find_transform_files(echo_file)
-                run_groups[run_key] = RunGroup(
-                    key=run_key, echo_files=[], transforms=transforms
+                    if self.use_fmriprep_mask:
+                        base_name = echo_file.name.split("_echo")[0]
+                        mask_path = echo_file.parent / f"{base_name}_desc-brain_mask.nii.gz"
+                        if self._file_exists(mask_path):
+                            run_groups[run_key].mask_file = mask_path
+                            self.logger.info(f"Found fMRIPrep mask for {run_key}: {mask_path}")
+                        else:
+                            self.logger.warning(
+                                f"Could not find fMRIPrep mask for {run_key}. "
+                                "Tedana will generate one."
+                            )
+
+                # Keep echoes sorted by echo time as they are added
+                bisect.insort(
+                    run_groups[run_key].echo_files,
+                    echo_info,
+                    key=lambda e: e.echo_time,
                 )
 
-                if self.use_fmriprep_mask:
-                    base_name = echo_file.name.split("_echo")[0]
-                    mask_path = echo_file.parent / f"{base_name}_desc-brain_mask.nii.gz"
-                    if mask_path.exists():
-                        run_groups[run_key].mask_file = mask_path
-                        self.logger.info(f"Found fMRIPrep mask for {run_key}: {mask_path}")
-                    else:
-                        self.logger.warning(
-                            f"Could not find fMRIPrep mask for {run_key}. "
-                            "Tedana will generate one."
-                        )
+        return run_groups
 
-            run_groups[run_key].echo_files.append(echo_info)
+    def _get_output_paths(
+        self, run_key: str
+    ) -> Tuple[Path, Optional[Path], Optional[Path]]:
+        """Expected (optcom, T1w, MNI) outputs for a run; None for spaces not produced."""
+        optcom_file = (
+            self.output_dir
+            / "tedana_combined"
+            / f"{run_key}_rec-tedana"
+            / "desc-optcom_bold.nii.gz"
+        )
+        if self.skip_ants_transform:
+            return optcom_file, None, None
 
-        # Sort echoes by echo time within each run
-        for run_group in run_groups.values():
-            run_group.echo_files.sort(key=lambda x: x.echo_time)
+        output_base = self.output_dir / "transformed" / run_key
+        t1w_output = mni_output = None
+        if "T1w" in self.spaces:
+            t1w_output = output_base / f"{run_key}_space-T1w_desc-optcom_bold.nii.gz"
+        if "MNI152NLin2009cAsym" in self.spaces:
+            mni_output = (
+                output_base
+                / f"{run_key}_space-MNI152NLin2009cAsym_desc-optcom_bold.nii.gz"
+            )
+        return optcom_file, t1w_output, mni_output
+
+    def _filter_completed_runs(
+        self, run_groups: Dict[str, RunGroup]
+    ) -> Tuple[
+        Dict[str, RunGroup], Dict[str, Tuple[Path, Optional[Path], Optional[Path]]]
+    ]:
+        """Split off runs whose final outputs exist and were made from the same inputs."""
+        remaining = {}
+        completed = {}
+        for run_key, run_group in run_groups.items():
+            outputs = self._get_output_paths(run_key)
+            # The optcom image only counts as final when no transforms are run
+            final = [p for p in outputs[1:] if p is not None] or [outputs[0]]
+            if all(p.exists() for p in final) and self._tedana_output_current(run_group):
+                completed[run_key] = outputs
+                self.logger.info(f"All outputs already exist for {run_key}, skipping")
+            else:
+                remaining[run_key] = run_group
+        return remaining, completed
 
-        return run_groups
+    def _call_tedana(
+        self,
+        echo_paths: List[str],
+        echo_times: List[float],
+        output_dir: Path,
+        tedana_kwargs: Dict[str, str],
+    ) -> None:
+        """Run the configured tedana workflow on echo file paths."""
+        # The workflows only take file names and build their own contiguous
+        # (voxels, echoes, time) array in tedana.io.load_data, so there is no
+        # benefit to stacking the echoes here first.
+        if self.full_pipeline:
+            tedana_workflow(
+                echo_paths,
+                echo_times,
+                out_dir=str(output_dir),
+                tedpca="kundu",
+                **tedana_kwargs,
+            )
+        else:
+            t2smap_workflow(echo_paths, echo_times, out_dir=str(output_dir), **tedana_kwargs)
+
+    def _tedana_signature(self, run_group: RunGroup) -> str:
+        """Cheap fingerprint of a run's tedana inputs and settings."""
+        digest = hashlib.sha256()
+        for echo_info in run_group.echo_files:
+            # The leading bytes cover the header and first volumes; with the
+            # size this catches replaced inputs without reading whole files
+            with open(echo_info.file_path, "rb") as f:
+                digest.update(f.read(65536))
+            digest.update(str(echo_info.file_path.stat().st_size).encode())
+        settings = (
+            [echo_info.echo_time for echo_info in run_group.echo_files],
+            self.trim_by,
+            self.full_pipeline,
+            str(run_group.mask_file),
+        )
+        digest.update(repr(settings).encode())
+        return digest.hexdigest()[:16]
+
+    def _tedana_output_current(self, run_group: RunGroup) -> bool:
+        """Whether a run's tedana output exists and was made from its current inputs."""
+        optcom_file = self._get_output_paths(run_group.key)[0]
+        if not optcom_file.exists():
+            return False
+
+        sig_file = optcom_file.parent / ".input_sig"
+        signature = self._tedana_signature(run_group)
+        if not sig_file.exists():
+            # Outputs from before signatures were recorded are trusted as-is
+            sig_file.write_text(signature)
+            return True
+        return sig_file.read_text().strip() == signature
 
     def _run_tedana(self, run_group: RunGroup) -> Path:
         """Run tedana on a group of echoes"""
         output_dir = self.output_dir / "tedana_combined" / f"{run_group.key}_rec-tedana"
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        # Check if output already exists
-        optcom_file = output_dir / "desc-optcom_bold.nii.gz"
-        if optcom_file.exists():
+        # Check if output already exists and was made from the same inputs
+        optcom_file = self._get_output_paths(run_group.key)[0]
+        if self._tedana_output_current(run_group):
             self.logger.info(
                 f"Tedana output already exists for {run_group.key}, skipping"
             )
             return optcom_file
 
+        if optcom_file.exists():
+            self.logger.info(
+                f"Inputs changed since tedana last ran for {run_group.key}, rerunning"
+            )
+            # tedana refuses to overwrite its own outputs, so clear the stale
+            # run directory. Anything resampled from it must be redone too,
+            # including spaces not requested this time, or they would pass as
+            # current once the new signature is written
+            shutil.rmtree(output_dir)
+            output_dir.mkdir(parents=True)
+            shutil.rmtree(self.output_dir / "transformed" / run_group.key, ignore_errors=True)
+
         self._log_memory_usage(f"before tedana {run_group.key}")
 
-        # Load images one at a time and store file paths for tedana
+        # tedana loads the echoes itself, so only file paths are passed along
         echo_times = [echo_info.echo_time for echo_info in run_group.echo_files]
         echo_file_paths = [
             str(echo_info.file_path) for echo_info in run_group.echo_files
@@ -280,74 +589,75 @@ class TedanaProcessor:
 
         # Apply trimming if needed by creating temporary trimmed files
         if self.trim_by > 0:
-            trimmed_files = []
+            trim_dir = self._make_trim_dir(run_group, output_dir)
             try:
-                for i, echo_info in enumerate(run_group.echo_files):
-                    self.logger.info(
-                        f"Processing echo {i + 1}/{len(run_group.echo_files)} for trimming"
+                try:
+                    trimmed_files = self._write_trimmed_echoes(run_group, trim_dir)
+                except OSError as e:
+                    # The free-space check is only a hint: parallel workers can
+                    # all pass it and then fill /dev/shm together
+                    if e.errno != errno.ENOSPC or trim_dir.parent == output_dir:
+                        raise
+                    self.logger.warning(
+                        f"Ran out of space in {trim_dir.parent} while trimming "
+                        f"{run_group.key}, writing trimmed echoes to {output_dir}"
                     )
-                    # Load, trim and save to temp file
-                    img = self._load_echo_image(echo_info)
-                    temp_file = output_dir / f"temp_echo-{i + 1:02d}_trimmed.nii.gz"
-                    nib.save(img, temp_file)
-                    trimmed_files.append(str(temp_file))
-                    # Explicitly delete image from memory
-                    # Again, reducing memory usage here.
-                    del img
-                    gc.collect()
+                    shutil.rmtree(trim_dir, ignore_errors=True)
+                    trim_dir = Path(
+                        tempfile.mkdtemp(prefix="temp_trimmed_", dir=output_dir)
+                    )
+                    trimmed_files = self._write_trimmed_echoes(run_group, trim_dir)
 
                 self.logger.info(
                     f"Running tedana for {run_group.key} with {len(trimmed_files)} echoes (trimmed)"
                 )
-                
-                if self.full_pipeline:
-                    tedana_workflow(
-                        trimmed_files,
-                        echo_times,
-                        out_dir=str(output_dir),
-                        tedpca="kundu",
-                        **tedana_kwargs,
-                    )
-                else:
-                    t2smap_workflow(trimmed_files, echo_times, out_dir=str(output_dir), **tedana_kwargs)
-
-                # Clean up temporary files
-                for temp_file in trimmed_files:
-                    Path(temp_file).unlink()
-
-            except Exception as e:
-                # Clean up temp files on error
-                for temp_file in trimmed_files:
-                    if Path(temp_file).exists():
-                        Path(temp_file).unlink()
-                raise e
+                self._call_tedana(trimmed_files, echo_times, output_dir, tedana_kwargs)
+
+            finally:
+                # Clean up temporary files, whether or not tedana succeeded
+                shutil.rmtree(trim_dir, ignore_errors=True)
         else:
             # Use original files directly with tedana
             self.logger.info(
                 f"Running tedana for {run_group.key} with {len(echo_file_paths)} echoes"
             )
-            
-            if self.full_pipeline:
-                tedana_workflow(
-                    echo_file_paths,
-                    echo_times,
-                    out_dir=str(output_dir),
-                    tedpca="kundu",
-                    **tedana_kwargs,
-                )
-            else:
-                t2smap_workflow(echo_file_paths, echo_times, out_dir=str(output_dir), **tedana_kwargs)
+            self._call_tedana(echo_file_paths, echo_times, output_dir, tedana_kwargs)
 
-        # Force garbage collection
-        gc.collect()
         self._log_memory_usage(f"after tedana {run_group.key}")
 
         # Verify output file exists
         if not optcom_file.exists():
             raise FileNotFoundError(f"Tedana output not found: {optcom_file}")
+        (output_dir / ".input_sig").write_text(self._tedana_signature(run_group))
 
         return optcom_file
 
+    def _run_ants_command(self, cmd: List[str], output_path: Path) -> None:
+        """Run an ANTs command, streaming its output to the log as it runs."""
+        self.logger.info(f"Running: {' '.join(cmd)}")
+
+        # Only the tail of the output is kept for the error message
+        tail = deque(maxlen=50)
+        with subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            env=self._ants_env(),
+        ) as process:
+            for line in process.stdout:
+                line = line.rstrip()
+                tail.append(line)
+                # Resamplings run concurrently, so tag lines with their output
+                self.logger.info(f"[{output_path.name}] {line}")
+            returncode = process.wait()
+
+        if returncode != 0:
+            self.logger.error(f"Command failed with return code {returncode}")
+            output = "\n".join(tail)
+            raise RuntimeError(f"{cmd[0]} failed for {output_path.name}: {output}")
+
     def _apply_transforms(
         self,
         input_image: Path,
@@ -356,8 +666,6 @@ class TedanaProcessor:
         reference: Path,
     ) -> Path:
         """Apply spatial transformations to an image."""
-        import os
-
         if output_path.exists():
             self.logger.warning(f"Skipping existing file: {output_path}")
             return output_path
@@ -378,83 +686,267 @@ class TedanaProcessor:
             f"Directory writable: {os.access(output_path.parent, os.W_OK) if output_path.parent.exists() else 'N/A'}"
         )
 
-        if self.apptainer_image:
-            # ANTs is natively available in the container
-            import subprocess
-
-            ants_binary = "antsApplyTransforms"
-
-            # Build the command
-            cmd = [
-                ants_binary,
-                "--input",
-                str(input_image),
-                "--reference-image",
-                str(reference),
-                "--output",
-                str(output_path),
-                "--interpolation",
-                "LanczosWindowedSinc",
-                "--input-image-type",
-                "3",
-            ]
+        # Call the ANTs CLI directly (natively available in the container);
+        # transforms are listed in ANTs stack order, last applied first.
+        # Resampling stays on the CPU: the MNI step needs fMRIPrep's composite
+        # nonlinear .h5 warp, which only ANTs reads, and the container ships
+        # no CUDA stack. Tune speed with ants_threads and interpolation.
+        cmd = [
+            "antsApplyTransforms",
+            "--dimensionality",
+            "3",
+            "--input-image-type",
+            "3",
+            "--input",
+            str(input_image),
+            "--reference-image",
+            str(reference),
+            "--output",
+            str(output_path),
+            "--interpolation",
+            "BSpline[3]" if self.interpolation == "BSpline" else self.interpolation,
+            "--float",
+            "1" if self.float_precision else "0",
+        ]
+        for transform in transforms:
+            cmd.extend(["--transform", str(transform)])
 
-            # Add transforms
-            for transform in reversed(transforms):
-                cmd.extend(["--transform", str(transform)])
+        self._run_ants_command(cmd, output_path)
 
-            self.logger.info(f"Running: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
+        return output_path
 
-            if result.returncode != 0:
-                self.logger.error(
-                    f"Command failed with return code {result.returncode}"
-                )
-                self.logger.error(f"STDOUT: {result.stdout}")
-                self.logger.error(f"STDERR: {result.stderr}")
-                raise RuntimeError(f"antsApplyTransforms failed: {result.stderr}")
+    def _compose_transforms(
+        self, transforms: List[Path], reference: Path, output_path: Path
+    ) -> Path:
+        """Collapse a chain of transforms into one displacement field on the reference grid."""
+        if output_path.exists():
+            self.logger.info(f"Reusing composed transform: {output_path}")
+            return output_path
 
-        else:
-            # Use nipype interface for local execution
-            at = ApplyTransforms()
-            at.inputs.input_image = str(input_image)
-            at.inputs.reference_image = str(reference)
-            at.inputs.output_image = str(output_path)
-            at.inputs.interpolation = "LanczosWindowedSinc"
-            at.inputs.transforms = [str(t) for t in transforms]
-            at.inputs.input_image_type = 3
-            at.run()
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        self.logger.info(f"Composing {len(transforms)} transforms into {output_path.name}")
+
+        # Write under a temporary name so an interrupted run never leaves a
+        # partial field that a rerun would pick up as cached
+        partial_path = output_path.with_name(f"partial_{output_path.name}")
+
+        # Writing "[field,1]" makes antsApplyTransforms emit the composite
+        # warp instead of a resampled image
+        cmd = [
+            "antsApplyTransforms",
+            "--dimensionality",
+            "3",
+            "--reference-image",
+            str(reference),
+            "--output",
+            f"[{partial_path},1]",
+        ]
+        for transform in transforms:
+            cmd.extend(["--transform", str(transform)])
 
-        return output_path
+        self._run_ants_command(cmd, output_path)
 
-    def _process_tedana_outputs(
-        self, optcom_file: Path, transforms: TransformFiles, run_key: str
-    ) -> Tuple[Path, Path]:
-        """Apply transformations to tedana outputs."""
-        output_base = self.output_dir / "transformed" / run_key
+        partial_path.replace(output_path)
+        return output_path
 
-        # T1w space output
-        t1w_output = output_base / f"{run_key}_space-T1w_desc-optcom_bold.nii.gz"
-        t1w_result = self._apply_transforms(
-            input_image=optcom_file,
-            output_path=t1w_output,
-            transforms=[transforms.bold_to_t1w],
-            reference=transforms.t1w_reference,
-        )
+    def _transform_to_mni(
+        self,
+        optcom_file: Path,
+        output_path: Path,
+        transforms: TransformFiles,
+        run_key: str,
+    ) -> Path:
+        """Resample the optcom image to MNI through a single composed warp."""
+        if output_path.exists():
+            self.logger.warning(f"Skipping existing file: {output_path}")
+            return output_path
 
-        # MNI space output
-        mni_output = (
-            output_base / f"{run_key}_space-MNI152NLin2009cAsym_desc-optcom_bold.nii.gz"
+        # boldref->T1w differs per run, so the composed warp is cached per run
+        # and kept for reruns. The name carries a fingerprint of the source
+        # transforms, so a rerun of fMRIPrep never reuses a stale field.
+        sources = [transforms.t1w_to_mni, transforms.bold_to_t1w, transforms.mni_reference]
+        digest = hashlib.sha256()
+        for source in sources:
+            stat = source.stat()
+            digest.update(f"{source}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        cache_dir = self.output_dir / "xfm_cache"
+        prefix = f"{run_key}_from-boldref_to-MNI152NLin2009cAsym_mode-image"
+        composed = cache_dir / f"{prefix}_desc-{digest.hexdigest()[:16]}_xfm.nii.gz"
+        self._compose_transforms(
+            [transforms.t1w_to_mni, transforms.bold_to_t1w],
+            transforms.mni_reference,
+            composed,
         )
-        mni_result = self._apply_transforms(
+        # Drop fields composed from earlier versions of the source transforms
+        for stale in cache_dir.glob(f"{prefix}_*xfm.nii.gz"):
+            if stale != composed:
+                stale.unlink(missing_ok=True)
+        return self._apply_transforms(
             input_image=optcom_file,
-            output_path=mni_output,
-            transforms=[transforms.t1w_to_mni, transforms.bold_to_t1w],
+            output_path=output_path,
+            transforms=[composed],
             reference=transforms.mni_reference,
         )
 
+    def _process_tedana_outputs(
+        self, optcom_file: Path, transforms: TransformFiles, run_key: str
+    ) -> Tuple[Optional[Path], Optional[Path]]:
+        """Apply transformations to tedana outputs for the requested spaces."""
+        _, t1w_output, mni_output = self._get_output_paths(run_key)
+
+        # When both spaces still need resampling, decompress the optcom image
+        # once here rather than in each ANTs call
+        pending = [p for p in (t1w_output, mni_output) if p is not None and not p.exists()]
+        resample_input = optcom_file
+        t1w_future = mni_future = None
+        try:
+            if len(pending) > 1:
+                # Inside the try so a partial copy (e.g. on ENOSPC) is removed
+                resample_input = optcom_file.with_name("temp_desc-optcom_bold.nii")
+                with gzip.open(optcom_file, "rb") as src, open(resample_input, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+
+            # The two resamplings share no outputs and each runs ANTs in its own
+            # subprocess, so threads are enough to run them side by side
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                # T1w space output
+                if t1w_output is not None:
+                    t1w_future = executor.submit(
+                        self._apply_transforms,
+                        input_image=resample_input,
+                        output_path=t1w_output,
+                        transforms=[transforms.bold_to_t1w],
+                        reference=transforms.t1w_reference,
+                    )
+
+                # MNI space output
+                if mni_output is not None:
+                    mni_future = executor.submit(
+                        self._transform_to_mni,
+                        resample_input,
+                        mni_output,
+                        transforms,
+                        run_key,
+                    )
+        finally:
+            if resample_input != optcom_file:
+                resample_input.unlink(missing_ok=True)
+
+        t1w_result = t1w_future.result() if t1w_future else None
+        mni_result = mni_future.result() if mni_future else None
         return t1w_result, mni_result
 
+    def _estimate_run_memory(self, run_group: RunGroup) -> int:
+        """Estimate peak bytes for one run from the echo headers, without loading data."""
+        n_bytes = 0
+        for echo_info in run_group.echo_files:
+            shape = _load_nifti(echo_info.file_path).header.get_data_shape()
+            n_volumes = max(shape[3] - self.trim_by, 1) if len(shape) > 3 else 1
+            # tedana holds every echo in memory as float64
+            n_bytes += int(np.prod(shape[:3])) * n_volumes * 8
+        return n_bytes
+
+    def _get_max_workers(self, run_groups: Dict[str, RunGroup]) -> int:
+        """Number of runs to process concurrently, bounded by available memory."""
+        max_workers = min(self.jobs, len(run_groups))
+        if max_workers <= 1:
+            return 1
+
+        per_run = max(self._estimate_run_memory(rg) for rg in run_groups.values())
+        available = psutil.virtual_memory().available
+        memory_bound = max(int(available // max(per_run, 1)), 1)
+        if memory_bound < max_workers:
+            self.logger.warning(
+                f"Limiting parallel runs from {max_workers} to {memory_bound}: "
+                f"~{per_run / 1024 / 1024:.0f} MB per run, "
+                f"{available / 1024 / 1024:.0f} MB available"
+            )
+            max_workers = memory_bound
+        return max_workers
+
+    def _process_run(
+        self, run_group: RunGroup
+    ) -> Tuple[Path, Optional[Path], Optional[Path]]:
+        """Run tedana and apply transformations for a single run."""
+        # Get optimally combined tedana image and run tedana
+        optcom_file = self._run_tedana(run_group)
+        return self._finish_run(run_group, optcom_file)
+
+    def _finish_run(
+        self, run_group: RunGroup, optcom_file: Path
+    ) -> Tuple[Path, Optional[Path], Optional[Path]]:
+        """Apply transformations to a run's tedana output."""
+        run_key = run_group.key
+
+        # Apply transformations (if not skipped)
+        if self.skip_ants_transform:
+            run_results = (optcom_file, None, None)
+        else:
+            t1w_output, mni_output = self._process_tedana_outputs(
+                optcom_file, run_group.transforms, run_key
+            )
+            run_results = (optcom_file, t1w_output, mni_output)
+
+        # Collect once per run, after tedana's arrays and the transformed
+        # outputs are done with, rather than after every step
+        gc.collect()
+        self._log_memory_usage(f"after processing {run_key}")
+
+        self.logger.info(f"Completed processing for {run_key}")
+        return run_results
+
+    def _process_runs_pipelined(
+        self, run_groups: Dict[str, RunGroup]
+    ) -> Dict[str, Tuple[Path, Optional[Path], Optional[Path]]]:
+        """Process runs in order, running tedana for the next run while the
+        current run's transforms are applied."""
+        # maxsize=1 keeps at most one finished optcom file waiting on ANTs
+        handoff = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def _tedana_worker():
+            try:
+                for idx, (run_key, run_group) in enumerate(run_groups.items(), 1):
+                    if stop.is_set():
+                        return
+                    self.logger.info(
+                        f"Processing run {run_key} ({idx}/{len(run_groups)})"
+                    )
+                    handoff.put((run_group, self._run_tedana(run_group)))
+            except BaseException as e:
+                handoff.put(e)
+            else:
+                handoff.put(None)
+
+        # Not a daemon: if a transform fails, the in-flight tedana run must get
+        # to clean up its scratch files before the error propagates
+        worker = threading.Thread(target=_tedana_worker)
+        worker.start()
+
+        results = {}
+        try:
+            while True:
+                item = handoff.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                run_group, optcom_file = item
+                results[run_group.key] = self._finish_run(run_group, optcom_file)
+        finally:
+            # Keep unblocking the tedana thread until it exits, so it sees the
+            # stop flag instead of starting more work and an in-flight run
+            # finishes its own cleanup before this returns or raises
+            stop.set()
+            while worker.is_alive():
+                try:
+                    handoff.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            worker.join()
+
+        return results
+
     def process(self) -> Dict[str, Tuple[Path, Path, Path]]:
         """Main processing pipeline."""
         self.logger.info(f"Processing subject {self.subject_id}")
@@ -468,49 +960,117 @@ class TedanaProcessor:
 
         # Find and group echo files
         echo_files = self._find_echo_files()
-        run_groups = self._group_echoes_by_run(echo_files)
+        path_groups = self._group_paths_by_run(echo_files)
 
-        # Check that all runs have exactly 3 echoes
-        for run_key, run_group in run_groups.items():
-            if len(run_group.echo_files) != 3:
+        # Check that all runs have exactly 3 echoes before reading any sidecar
+        for run_key, echo_paths in path_groups.items():
+            if len(echo_paths) != 3:
                 raise ValueError(
-                    f"Run '{run_key}' must have exactly 3 echoes, but found {len(run_group.echo_files)} echoes"
+                    f"Run '{run_key}' must have exactly 3 echoes, but found {len(echo_paths)} echoes"
                 )
 
-        valid_runs = run_groups
+        # Skip runs that are done; this needs echo times for the input signature
+        valid_runs, completed_runs = self._filter_completed_runs(
+            self._load_grouped_echoes(path_groups)
+        )
 
         self.logger.info(f"Processing {len(valid_runs)} runs with 3 echoes each")
 
-        # Process each run sequentially 
-        # Better memory usage than loading all these in and then running, as done before.
-        results = {}
-        for run_key, run_group in valid_runs.items():
-            self.logger.info(
-                f"Processing run {run_key} ({list(valid_runs.keys()).index(run_key) + 1}/{len(valid_runs)})"
-            )
-
-            # Get optimally combined tedana image and run tedana
-            optcom_file = self._run_tedana(run_group)
-
-            # Apply transformations (if not skipped)
-            if self.skip_ants_transform:
-                results[run_key] = (optcom_file, None, None)
-            else:
-                t1w_output, mni_output = self._process_tedana_outputs(
-                    optcom_file, run_group.transforms, run_key
-                )
-                results[run_key] = (optcom_file, t1w_output, mni_output)
+        max_workers = self._get_max_workers(valid_runs)
 
-            # Force garbage collection between runs
-            gc.collect()
-            self._log_memory_usage(f"after processing {run_key}")
+        results = dict(completed_runs)
+        if max_workers == 1:
+            # Process each run sequentially, only overlapping one run's tedana
+            # with the previous run's transforms.
+            # Better memory usage than loading all these in and then running, as done before.
+            results.update(self._process_runs_pipelined(valid_runs))
+        else:
+            self.logger.info(f"Processing runs with {max_workers} parallel workers")
+            cores_per_worker = max(_available_cpus() // max_workers, 1)
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(cores_per_worker,),
+            ) as executor:
+                futures = []
+                for idx, (run_key, run_group) in enumerate(valid_runs.items(), 1):
+                    self.logger.info(
+                        f"Submitting run {run_key} ({idx}/{len(valid_runs)})"
+                    )
+                    futures.append(
+                        executor.submit(
+                            _process_single_run, (self, run_group, cores_per_worker)
+                        )
+                    )
+                for future in as_completed(futures):
+                    run_key, run_results = future.result()
+                    results[run_key] = run_results
 
-            self.logger.info(f"Completed processing for {run_key}")
+            # Keep results in run order regardless of completion order
+            results = {
+                run_key: results[run_key]
+                for run_key in [*completed_runs, *valid_runs]
+            }
 
         self._log_memory_usage("end of processing")
         return results
 
 
+@functools.lru_cache(maxsize=None)
+def _parse_bids_entities(filename: str) -> Dict[str, Optional[str]]:
+    """Parse sub/ses/task/run entities from a filename, cached per filename."""
+    components = dict.fromkeys(["sub", "ses", "task", "run"])
+    for entity, label in _BIDS_RE.findall(filename):
+        # Keep the first occurrence of each entity
+        if components[entity] is None:
+            components[entity] = f"{entity}-{label}"
+    return components
+
+
+def _load_nifti(path: Path) -> nib.Nifti1Image:
+    """Load a NIfTI lazily; nothing here reads voxel data through nibabel."""
+    # mmap only helps uncompressed files and is ignored for .gz. This replaces
+    # the old full-load path, which used mmap=False because it always read
+    # every voxel. Reading a scaled image through a memmap goes through
+    # nibabel's scaling path and can be far slower than a plain read, so
+    # callers should stick to headers and the proxy's offset rather than
+    # pulling arrays from dataobj.
+    return nib.load(str(path), mmap=not str(path).endswith(".gz"))
+
+
+def _available_cpus() -> int:
+    """Number of CPUs this process may run on (respects SLURM/cgroup affinity)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _init_worker(cores_per_worker: int) -> None:
+    """Pin a pool worker to its own slice of CPUs so workers don't oversubscribe."""
+    # ANTs thread counts are set per call from ants_threads (see _ants_env),
+    # which defaults to at most half of a worker's slice since each run may
+    # resample to both spaces at once. tedana's BLAS/OpenMP pools were sized
+    # when numpy was imported, so _process_single_run limits them instead.
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        n_slices = max(len(cpus) // cores_per_worker, 1)
+        # Pool workers are numbered from 1 in the order they are started
+        worker_idx = (multiprocessing.current_process()._identity[0] - 1) % n_slices
+        worker_cpus = cpus[worker_idx * cores_per_worker:][:cores_per_worker]
+        if worker_cpus:
+            os.sched_setaffinity(0, worker_cpus)
+
+
+def _process_single_run(
+    args: Tuple["TedanaProcessor", RunGroup, int],
+) -> Tuple[str, Tuple[Path, Optional[Path], Optional[Path]]]:
+    """Process one run in a worker process (module level so it can be pickled)."""
+    processor, run_group, cores_per_worker = args
+    # Keep tedana's numpy threads within this worker's CPU slice
+    with threadpool_limits(limits=cores_per_worker):
+        return run_group.key, processor._process_run(run_group)
+
+
 def get_parser() -> argparse.ArgumentParser:
     """Create command-line argument parser."""
     parser = argparse.ArgumentParser(
@@ -535,11 +1095,6 @@ def get_parser() -> argparse.ArgumentParser:
         default=0,
         help="Number of volumes to trim from beginning",
     )
-    parser.add_argument(
-        "--apptainer-image",
-        type=str,
-        help="Path to apptainer image containing ANTs tools",
-    )
     parser.add_argument(
         "--task-name",
         type=str,
@@ -560,6 +1115,38 @@ def get_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Use the native-space brain mask from fMRIPrep for tedana.",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of runs to process in parallel, or 0 for one per available CPU "
+        "(limited by the number of runs and available memory)",
+    )
+    parser.add_argument(
+        "--spaces",
+        nargs="+",
+        choices=OUTPUT_SPACES,
+        default=list(OUTPUT_SPACES),
+        help="Output spaces to resample the optimally combined image into",
+    )
+    parser.add_argument(
+        "--interpolation",
+        choices=["BSpline", "LanczosWindowedSinc", "Linear"],
+        default="BSpline",
+        help="Interpolation for antsApplyTransforms (BSpline uses order 3)",
+    )
+    parser.add_argument(
+        "--double-precision",
+        action="store_true",
+        help="Resample in double instead of single precision",
+    )
+    parser.add_argument(
+        "--ants-threads",
+        type=int,
+        default=None,
+        help="Threads per antsApplyTransforms call "
+        "(default: available CPUs split across concurrent calls, at most 8)",
+    )
     return parser
 
 
@@ -574,11 +1161,15 @@ def main():
         output_dir=args.output_dir,
         subject_id=args.subj_id,
         trim_by=args.trim_by,
-        apptainer_image=args.apptainer_image,
         task_name=args.task_name,
         full_pipeline=args.full_pipeline,
         skip_ants_transform=args.skip_ants_transform,
         use_fmriprep_mask=args.use_fmriprep_mask,
+        jobs=args.jobs,
+        spaces=args.spaces,
+        ants_threads=args.ants_threads,
+        interpolation=args.interpolation,
+        float_precision=not args.double_precision,
     )
 
     # Run processing
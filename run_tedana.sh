@@ -1,12 +1,12 @@
 #!/bin/bash
 
-# Usage: run_tedana.sh <subs_file> <output_dir> <fmriprep_dir> <apptainer_image> [email] [task_name] [trim_by] [full_pipeline] [skip_ants_transform] [use_fmriprep_mask]
-# Example: run_tedana.sh /path/to/subs.txt /path/to/output /path/to/fmriprep /path/to/image.sif user@email.com rest 7 true false true
+# Usage: run_tedana.sh <subs_file> <output_dir> <fmriprep_dir> <apptainer_image> [email] [task_name] [trim_by] [full_pipeline] [skip_ants_transform] [use_fmriprep_mask] [spaces]
+# Example: run_tedana.sh /path/to/subs.txt /path/to/output /path/to/fmriprep /path/to/image.sif user@email.com rest 7 true false true MNI152NLin2009cAsym
 
 # Check arguments
 if [ $# -lt 4 ]; then
-    echo "Usage: $0 <subs_file> <output_dir> <fmriprep_dir> <apptainer_image> [email] [task_name] [trim_by] [full_pipeline] [skip_ants_transform] [use_fmriprep_mask]"
-    echo "Example: $0 /path/to/subs.txt /path/to/output /path/to/fmriprep /path/to/image.sif user@email.com rest 7 true false true"
+    echo "Usage: $0 <subs_file> <output_dir> <fmriprep_dir> <apptainer_image> [email] [task_name] [trim_by] [full_pipeline] [skip_ants_transform] [use_fmriprep_mask] [spaces]"
+    echo "Example: $0 /path/to/subs.txt /path/to/output /path/to/fmriprep /path/to/image.sif user@email.com rest 7 true false true MNI152NLin2009cAsym"
     echo ""
     echo "Arguments:"
     echo "  subs_file: Path to file containing subject IDs (one per line)"
@@ -19,6 +19,7 @@ if [ $# -lt 4 ]; then
     echo "  full_pipeline: true/false (default: false) - Run full tedana workflow with denoising vs t2smap only"
     echo "  skip_ants_transform: true/false (default: false) - Skip ANTs transformations to T1w/MNI space"
     echo "  use_fmriprep_mask: true/false (default: false) - Use fMRIPrep brain mask for tedana"
+    echo "  spaces: Space-separated output spaces, e.g. 'T1w MNI152NLin2009cAsym' (default: both)"
     exit 1
 fi
 
@@ -36,6 +37,7 @@ TRIM_BY="${7:-0}"
 FULL_PIPELINE="${8:-false}"
 SKIP_ANTS_TRANSFORM="${9:-false}"
 USE_FMRIPREP_MASK="${10:-false}"
+SPACES="${11:-}"
 
 # Validate inputs
 if [ ! -f "$SUBS_FILE" ]; then
@@ -76,5 +78,5 @@ sbatch --array=1-$NUM_SUBJECTS \
        --error="${SCRIPT_DIR}/log/%x-%A-%a.err" \
        --mail-user="$EMAIL" \
        --mail-type=END \
-       --export=SUBS_FILE="$SUBS_FILE",OUTDIR="$OUTDIR",FMRIPREP_DIR="$FMRIPREP_DIR",APPTAINER_IMAGE="$APPTAINER_IMAGE",SCRIPT_DIR="$SCRIPT_DIR",TASK_NAME="$TASK_NAME",TRIM_BY="$TRIM_BY",FULL_PIPELINE="$FULL_PIPELINE",SKIP_ANTS_TRANSFORM="$SKIP_ANTS_TRANSFORM",USE_FMRIPREP_MASK="$USE_FMRIPREP_MASK" \
+       --export=SUBS_FILE="$SUBS_FILE",OUTDIR="$OUTDIR",FMRIPREP_DIR="$FMRIPREP_DIR",APPTAINER_IMAGE="$APPTAINER_IMAGE",SCRIPT_DIR="$SCRIPT_DIR",TASK_NAME="$TASK_NAME",TRIM_BY="$TRIM_BY",FULL_PIPELINE="$FULL_PIPELINE",SKIP_ANTS_TRANSFORM="$SKIP_ANTS_TRANSFORM",USE_FMRIPREP_MASK="$USE_FMRIPREP_MASK",SPACES="$SPACES" \
        "$SCRIPT_DIR/run_tedana_worker.sh"
\ No newline at end of file
@@ -50,8 +50,7 @@ CMD="apptainer exec \
     python3 \"$SCRIPT_DIR_ABS/run_tedana.py\" \
     --subj-id=\"$SUBJ_ID\" \
     --output-dir=\"$OUTDIR_ABS\" \
-    --fmriprep-dir=\"$FMRIPREP_DIR_ABS\" \
-    --apptainer-image=\"$APPTAINER_IMAGE\""
+    --fmriprep-dir=\"$FMRIPREP_DIR_ABS\""
 
 # Add trim_by parameter
 if [ "$TRIM_BY" -gt 0 ]; then
@@ -75,6 +74,10 @@ if [ "$USE_FMRIPREP_MASK" = "true" ]; then
     CMD="$CMD --use-fmriprep-mask"
 fi
 
+if [ -n "$SPACES" ]; then
+    CMD="$CMD --spaces $SPACES"
+fi
+
 # Execute the command
 echo "Running: $CMD"
 eval "$CMD"